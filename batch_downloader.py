@@ -6,23 +6,31 @@ Batch downloader for multiple sequences
 
 import os
 import sys
-import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from sequence_downloader import main as download_single_sequence
+from mapillary_api import RateLimiter, DEFAULT_RPS
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Number of sequences downloaded in parallel by default
+DEFAULT_CONCURRENCY = min(8, 3 * (os.cpu_count() or 1))
+
+def iter_sequences(filename):
+    """Yield sequence IDs from file one at a time"""
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            seq_id = line.strip()
+            if seq_id and not seq_id.startswith('#'):  # Skip empty lines and comments
+                yield seq_id
+
 def read_sequences_from_file(filename):
     """Read sequence IDs from file"""
-    sequences = []
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            for line in f:
-                seq_id = line.strip()
-                if seq_id and not seq_id.startswith('#'):  # Skip empty lines and comments
-                    sequences.append(seq_id)
+        sequences = list(iter_sequences(filename))
         logger.info(f"Read {len(sequences)} sequences from {filename}")
         return sequences
     except FileNotFoundError:
@@ -32,34 +40,71 @@ def read_sequences_from_file(filename):
         logger.error(f"Error reading file: {e}")
         return []
 
-def download_sequences(sequence_ids, delay=1.0, quality=None):
-    """Batch download sequences"""
-    total = len(sequence_ids)
+def download_sequences(sequence_ids, quality=None, concurrency=DEFAULT_CONCURRENCY, rps=DEFAULT_RPS,
+                       verbose=False):
+    """
+    Batch download sequences using a bounded pool of workers
+
+    sequence_ids can be any iterable (e.g. iter_sequences); it is consumed
+    lazily, so downloads start before the whole list has been read.
+    On Ctrl+C, queued sequences are cancelled and the running ones stop
+    before their next image. Returns a (successful, failed) tuple.
+    """
+    # All workers share one request budget
+    rate_limiter = RateLimiter(rps)
+    stop = threading.Event()
     successful = 0
     failed = 0
-
-    logger.info(f"Starting batch download of {total} sequences")
-
-    for i, sequence_id in enumerate(sequence_ids, 1):
-        logger.info(f"Processing sequence {i}/{total}: {sequence_id}")
-
+    pending = {}  # future -> sequence ID
+
+    logger.info(f"Starting batch download ({concurrency} in parallel)")
+
+    def collect(done):
+        nonlocal successful, failed
+        for future in done:
+            sequence_id = pending.pop(future)
+            try:
+                if future.result() is False:
+                    failed += 1
+                    logger.error("❌ Sequence %s download failed, see its log file", sequence_id)
+                else:
+                    successful += 1
+                    logger.debug("✅ Sequence %s download completed", sequence_id)
+
+            except Exception as e:
+                failed += 1
+                logger.error("❌ Sequence %s download failed: %s", sequence_id, e)
+
+            # One progress line per finished sequence; each sequence
+            # already logs its own per-image details
+            logger.info("Progress: %d sequences done, %d failed", successful + failed, failed)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
         try:
-            # Download single sequence with quality parameter
-            download_single_sequence(sequence_id, quality)
-
-            successful += 1
-            logger.info(f"✅ Sequence {sequence_id} download completed")
-
-        except Exception as e:
-            failed += 1
-            logger.error(f"❌ Sequence {sequence_id} download failed: {e}")
-
-        # Add delay to avoid API limits
-        if i < total:  # No delay for the last one
-            logger.info(f"Waiting {delay} seconds...")
-            time.sleep(delay)
+            for sequence_id in sequence_ids:
+                # Keep at most `concurrency` sequences in flight
+                if len(pending) >= concurrency:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                # Download single sequence with quality parameter
+                future = executor.submit(download_single_sequence, sequence_id, quality,
+                                         rate_limiter=rate_limiter, verbose=verbose, stop_event=stop)
+                pending[future] = sequence_id
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        except BaseException:
+            # Ctrl+C: running sequences finish only their images in flight
+            logger.warning("⏹️  Stopping, waiting for %d running sequences to finish their current images",
+                           len(pending))
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
 
     logger.info(f"Batch download completed: {successful} successful, {failed} failed")
+    return successful, failed
 
 def main():
     """Main program"""
@@ -69,9 +114,25 @@ def main():
     parser.add_argument('sequences_file', help='File containing sequence IDs')
     parser.add_argument('-q', '--quality', type=int, choices=range(1, 101),
                        help='JPEG quality (1-100). If not specified, saves original quality')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                       help=f'Number of sequences to download in parallel (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--rps', type=float, default=DEFAULT_RPS,
+                       help=f'Maximum API requests per second across all workers (default: {DEFAULT_RPS:g})')
+    parser.add_argument('-y', '--yes', action='store_true',
+                       help='Skip confirmation and start downloading while the file is being read')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                       help='Log debug details for every sequence')
 
     args = parser.parse_args()
 
+    if args.concurrency < 1:
+        logger.error(f"❌ Concurrency must be at least 1, current value: {args.concurrency}")
+        sys.exit(1)
+
+    if args.rps <= 0:
+        logger.error(f"❌ Requests per second must be positive, current value: {args.rps}")
+        sys.exit(1)
+
     # Check if config.py exists
     if not os.path.exists("config.py"):
         logger.error("❌ config.py file not found!")
@@ -81,6 +142,20 @@ def main():
 
     sequences_file = args.sequences_file
 
+    if args.yes:
+        # Stream sequences straight from the file into the workers
+        if not os.path.isfile(sequences_file):
+            logger.error(f"File not found: {sequences_file}")
+            sys.exit(1)
+
+        successful, failed = download_sequences(iter_sequences(sequences_file), quality=args.quality,
+                                                concurrency=args.concurrency, rps=args.rps,
+                                                verbose=args.verbose)
+        if successful + failed == 0:
+            logger.error("No sequences found")
+            sys.exit(1)
+        return
+
     # Read sequences
     sequences = read_sequences_from_file(sequences_file)
 
@@ -99,7 +174,8 @@ def main():
         sys.exit(0)
 
     # Start download
-    download_sequences(sequences, quality=args.quality)
+    download_sequences(sequences, quality=args.quality, concurrency=args.concurrency, rps=args.rps,
+                       verbose=args.verbose)
 
 if __name__ == "__main__":
     main()
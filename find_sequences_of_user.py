@@ -5,7 +5,7 @@ Mapillary User Sequences Finder
 Features:
 - Search for all Mapillary sequences of a specified user
 - Support camera type filtering (perspective photos or 360-degree spherical photos)
-- Group sequences by date and write to file in real-time
+- Group sequences by (UTC) date and write to file in real-time
 
 Writing Logic:
 1. Record the first found date and its sequences
@@ -23,7 +23,7 @@ Output Format:
 - Each date block separated by empty lines
 
 Usage:
-python3 find_sequences_of_user.py <username> [-p <max_pages>] [-f <filter>]
+python3 find_sequences_of_user.py <username> [-p <max_pages>] [-f <filter>] [--rps <rps>]
 
 Parameters:
 - username: Mapillary username to search for
@@ -32,54 +32,79 @@ Parameters:
   - all: Search all types
   - 360: Search only 360-degree photos (spherical)
   - regular: Search only perspective photos
+- --rps: Maximum API requests per second (optional, default is 10)
 
 Examples:
 python3 find_sequences_of_user.py username -p 50 -f regular
 python3 find_sequences_of_user.py username -f 360
 """
 
-import requests
+import os
+import queue
+import sys
+import threading
 import time
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 from config import access_token
+from mapillary_api import RateLimiter, DEFAULT_RPS, create_session, get_with_retry, parse_json
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Number of result pages fetched ahead of processing
+PAGE_PREFETCH_DEPTH = 3
 
-def write_file_header(filename, username, max_pages, camera_type_filter):
-    """Write file header with search parameters"""
+# Milliseconds per day; image timestamps are grouped into UTC day buckets
+MS_PER_DAY = 86_400_000
+
+# Write buffer for the output file; date blocks are flushed in large writes
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Server-side image_type filter matching each camera_type filter
+IMAGE_TYPE_FOR_CAMERA_TYPE = {
+    'spherical': 'pano',
+    'perspective': 'flat',
+}
+
+
+def write_file_header(f, username, max_pages, camera_type_filter):
+    """Write file header with search parameters to the open output file"""
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(f"# Search Mapillary Sequences by User\n")
-            f.write(f"# User: {username}\n")
-            f.write(f"# Time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"# Max Pages: {max_pages if max_pages else 'All'}\n")
-            f.write(f"# Image Type Filter: {camera_type_filter if camera_type_filter else 'All'}\n\n")
+        f.writelines([
+            f"# Search Mapillary Sequences by User\n",
+            f"# User: {username}\n",
+            f"# Time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n",
+            f"# Max Pages: {max_pages if max_pages else 'All'}\n",
+            f"# Image Type Filter: {camera_type_filter if camera_type_filter else 'All'}\n\n",
+        ])
         return True
     except Exception as e:
         logger.error(f"Error writing file header: {e}")
         return False
 
-def write_sequences_for_date(date, sequences, sequence_timestamps, filename):
-    """Write sequences for a single date to file"""
-    try:
-        with open(filename, 'a', encoding='utf-8') as f:
-            f.write(f"# {date}\n")
+def format_day(day):
+    """Format a UTC day bucket (days since the epoch) as YYYYMMDD"""
+    return datetime.fromtimestamp(day * 86400, tz=timezone.utc).strftime('%Y%m%d')
 
-            # Sort sequences by timestamp (newest first)
-            if sequence_timestamps:
-                sorted_sequences = sorted(sequences,
-                                        key=lambda seq: sequence_timestamps.get(seq, 0),
-                                        reverse=True)
-            else:
-                sorted_sequences = sorted(sequences)
-
-            for seq in sorted_sequences:
-                f.write(f"{seq}\n")
-            f.write("\n")  # Add empty line after date
+def write_sequences_for_date(day, sequences, sequence_timestamps, f):
+    """Write sequences for a single UTC day bucket to the open output file"""
+    date = format_day(day)
+    try:
+        # Sort sequences by timestamp (newest first, ties by ID). Sorting
+        # (-timestamp, seq) tuples compares in C without a key callback.
+        if sequence_timestamps:
+            get_timestamp = sequence_timestamps.get
+            decorated = [(-get_timestamp(seq, 0), seq) for seq in sequences]
+            decorated.sort()
+            sorted_sequences = [seq for _, seq in decorated]
+        else:
+            sorted_sequences = sorted(sequences)
+
+        # One write per date block; the empty line separates dates
+        body = "\n".join(sorted_sequences)
+        f.write(f"# {date}\n{body}\n\n")
 
         logger.info(f"✅ Written date {date} with {len(sequences)} sequences")
         return True
@@ -87,72 +112,168 @@ def write_sequences_for_date(date, sequences, sequence_timestamps, filename):
         logger.error(f"Error writing date {date} to file: {e}")
         return False
 
-def get_all_user_sequences(username, max_pages=None, camera_type_filter=None, output_file=None):
-    """Get all sequences for specified user with optional camera type filtering"""
-    header = {'Authorization': f'OAuth {access_token}'}
+def finalize_output_file(f, filename):
+    """Flush the open output file to disk, close it and atomically move it to filename"""
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(f.name, filename)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving {filename}: {e}")
+        return False
+
+def fetch_page(session, url, rate_limiter):
+    """
+    Fetch one page of image search results
+
+    Returns (images, next_url). Images are projected to
+    (sequence, timestamp, camera_type) tuples, the only fields used.
+    Sequence IDs are interned: most images repeat the ID of the previous
+    one, so they share one string object and compare by identity in the
+    sequence dict and sets.
+    """
+    r = get_with_retry(session, url, rate_limiter, logger=logger)
+    data = parse_json(r.content)
+
+    intern = sys.intern
+    images = []
+    for img in data.get('data', []):
+        seq_id = img.get('sequence')
+        images.append((
+            intern(seq_id) if seq_id else seq_id,
+            img.get('captured_at') or img.get('created_at'),
+            img.get('camera_type', '')
+        ))
+    next_url = data.get('paging', {}).get('next')
+    return images, next_url
+
+def put_page(pages, item, stop):
+    """Put an item on the page queue unless the consumer has stopped"""
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def produce_pages(session, url, rate_limiter, max_pages, pages, stop):
+    """
+    Fetch pages in order and queue (images, next_url, error) tuples,
+    followed by None once there are no more pages
+    """
+    page = 1
+    try:
+        while url and (max_pages is None or page <= max_pages):
+            images, url = fetch_page(session, url, rate_limiter)
+            if not put_page(pages, (images, url, None), stop):
+                return
+            page += 1
+    except Exception as e:
+        put_page(pages, (None, None, e), stop)
+    put_page(pages, None, stop)
+
+def get_all_user_sequences(username, max_pages=None, camera_type_filter=None, output_file=None, rate_limiter=None):
+    """
+    Get all sequences for specified user with optional camera type filtering
+
+    output_file is an open text file; each finished date block is written to it.
+    Returns (total_sequences, sequence_timestamps, completed). completed is
+    False if a page could not be fetched, in which case the results only
+    cover the pages before it.
+    """
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(DEFAULT_RPS)
+    # Reuse one keep-alive connection for all pages
+    session = create_session(access_token)
     sequence_timestamps = {}  # Store timestamp for each sequence
-    current_date = None  # Track current date being processed
+    current_day = None  # Track current UTC day bucket being processed
     current_sequences = set()  # Track sequences for current date
     total_sequences = 0  # Count total sequences found
+    completed = True  # False once a page fails
 
     # First page - include camera_type in fields
     url = f'https://graph.mapillary.com/images?fields=id,sequence,creator,created_at,camera_type,captured_at&creator_username={username}&limit=100'
 
+    # Let the API drop non-matching images; paging.next keeps the parameter
+    if camera_type_filter and camera_type_filter.lower() in IMAGE_TYPE_FOR_CAMERA_TYPE:
+        url += f'&image_type={IMAGE_TYPE_FOR_CAMERA_TYPE[camera_type_filter.lower()]}'
+
+    # Mapillary returns camera_type as a lowercase enum ("perspective",
+    # "spherical", ...), so compare exactly against the lowercased filter.
+    # The server-side image_type filter is coarser (e.g. "pano" also covers
+    # equirectangular), so this check is still needed.
+    filter_camera_type = camera_type_filter.lower() if camera_type_filter else None
+
+    # A background producer fetches pages ahead of processing, keeping up
+    # to PAGE_PREFETCH_DEPTH pages buffered. Each page's next URL is only
+    # known from the previous response, so the lead is built sequentially.
+    pages = queue.Queue(maxsize=PAGE_PREFETCH_DEPTH)
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=produce_pages,
+        args=(session, url, rate_limiter, max_pages, pages, stop),
+        daemon=True
+    )
+    producer.start()
+
+    # Bind lookups used for every image once, outside the page loop
+    get_sequence_timestamp = sequence_timestamps.get
+    log_info = logger.info
+
     page = 1
-    while url and (max_pages is None or page <= max_pages):
-        logger.info(f"Fetching page {page}...")
+    while True:
+        item = pages.get()
+        if item is None:
+            break
+        log_info("Processing page %d...", page)
 
         try:
-            r = requests.get(url, headers=header, timeout=30)
-            r.raise_for_status()
-            data = r.json()
+            images, next_url, error = item
+            if error is not None:
+                raise error
 
-            images = data.get('data', [])
-            logger.info(f"Found {len(images)} images")
+            if not next_url:
+                log_info("Reached the last page")
 
+            log_info("Found %d images", len(images))
 
             # Process sequences for current page
-            for img in images:
+            for seq_id, timestamp, img_camera_type in images:
                 # Apply camera type filter if specified
-                if camera_type_filter:
-                    img_camera_type = img.get('camera_type', '')
-                    if camera_type_filter.lower() not in img_camera_type.lower():
-                        continue
-
-                if 'sequence' in img and img['sequence']:
-                    seq_id = img['sequence']
+                if filter_camera_type and img_camera_type != filter_camera_type:
+                    continue
 
+                if seq_id:
                     # Group sequence by date and store timestamp
-                    timestamp = None
-                    if 'captured_at' in img and img['captured_at']:
-                        timestamp = img['captured_at']
-                    elif 'created_at' in img and img['created_at']:
-                        timestamp = img['created_at']
-
                     if timestamp:
-                        # Store the latest timestamp for this sequence
-                        if seq_id not in sequence_timestamps or timestamp > sequence_timestamps[seq_id]:
+                        # Store the latest timestamp for this sequence (one lookup per image)
+                        prev_timestamp = get_sequence_timestamp(seq_id)
+                        if prev_timestamp is None or timestamp > prev_timestamp:
                             sequence_timestamps[seq_id] = timestamp
 
-                        # Convert timestamp to date string (YYYYMMDD format)
-                        img_date = datetime.fromtimestamp(timestamp / 1000).strftime('%Y%m%d')
+                        # Group by UTC day; the YYYYMMDD string is only
+                        # formatted when a date block is logged or written
+                        img_day = timestamp // MS_PER_DAY
 
                         # 1. Record the first found date
-                        if current_date is None:
-                            current_date = img_date
+                        if current_day is None:
+                            current_day = img_day
                             current_sequences = set()
-                            logger.info(f"📅 Found first date: {img_date}")
+                            log_info("📅 Found first date: %s", format_day(img_day))
 
                         # 2. Continue recording sequences for the current date
-                        if img_date == current_date:
+                        if img_day == current_day:
                             current_sequences.add(seq_id)
                         # 3. When a new date is discovered
-                        elif img_date != current_date:
-                            logger.info(f"📅 Found new date: {img_date}")
+                        else:
+                            log_info("📅 Found new date: %s", format_day(img_day))
                             # a. Write the currently recorded data
-                            if output_file and current_date and current_sequences:
+                            if output_file and current_sequences:
                                 write_sequences_for_date(
-                                    current_date,
+                                    current_day,
                                     current_sequences,
                                     sequence_timestamps,
                                     output_file
@@ -161,34 +282,33 @@ def get_all_user_sequences(username, max_pages=None, camera_type_filter=None, ou
 
                             # b. Clear the recorded data
                             # c. Start recording the new date and its sequences
-                            current_date = img_date
+                            current_day = img_day
                             current_sequences = {seq_id}
 
-            # Check if there's a next page
-            if 'paging' in data and 'next' in data['paging']:
-                url = data['paging']['next']
-                page += 1
-                time.sleep(0.5)  # Avoid API limits
-            else:
-                url = None
-                logger.info("Reached the last page")
+            page += 1
 
         except Exception as e:
             logger.error(f"Error fetching page {page}: {e}")
+            completed = False
             break
 
+    # Stop the producer (it may be waiting on a full queue after an error)
+    stop.set()
+    producer.join()
+    session.close()
+
     # 4. If search is completed, write the currently recorded data
-    if output_file and current_date and current_sequences:
+    if output_file and current_day is not None and current_sequences:
         write_sequences_for_date(
-            current_date,
+            current_day,
             current_sequences,
             sequence_timestamps,
             output_file
         )
-        logger.info(f"✅ Written final date {current_date}")
+        logger.info(f"✅ Written final date {format_day(current_day)}")
         total_sequences += len(current_sequences)
 
-    return total_sequences, sequence_timestamps
+    return total_sequences, sequence_timestamps, completed
 
 def main():
     """Main program"""
@@ -199,9 +319,15 @@ def main():
     parser.add_argument('-p', '--max-pages', type=int, help='Maximum number of pages to search')
     parser.add_argument('-f', '--filter', choices=['all', '360', 'regular'],
                        default='all', help='Filter by camera type (360=spherical, regular=perspective)')
+    parser.add_argument('--rps', type=float, default=DEFAULT_RPS,
+                       help=f'Maximum API requests per second (default: {DEFAULT_RPS:g})')
 
     args = parser.parse_args()
 
+    if args.rps <= 0:
+        print(f"❌ Requests per second must be positive, current value: {args.rps}")
+        return
+
     logger.info("=== Mapillary User Sequences Finder ===")
     logger.info("")
 
@@ -230,21 +356,45 @@ def main():
     if camera_type_filter:
         logger.info(f"Filtering for camera type: {camera_type_filter}")
 
-    # Prepare output file
+    # Prepare output file; results are written to a temporary file and only
+    # moved into place once the search is done, so batch_downloader.py never
+    # sees a half-written list
     output_file = f"sequences_{username}.txt"
+    tmp_output_file = f"{output_file}.tmp"
 
-    # Write file header
-    if not write_file_header(output_file, username, max_pages, camera_type_filter):
+    # The output file stays open for the whole search instead of being
+    # reopened for every date block
+    try:
+        f = open(tmp_output_file, 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE)
+    except OSError as e:
+        logger.error(f"Error opening {tmp_output_file}: {e}")
         print(f"❌ Error preparing output file")
         return
 
-    logger.info(f"📝 Output file prepared: {output_file}")
-    logger.info("")
+    try:
+        # Write file header
+        if not write_file_header(f, username, max_pages, camera_type_filter):
+            print(f"❌ Error preparing output file")
+            return
 
-    # Search sequences with real-time file writing
-    total_sequences, sequence_timestamps = get_all_user_sequences(
-        username, max_pages, camera_type_filter, output_file
-    )
+        logger.info(f"📝 Output file prepared: {tmp_output_file}")
+        logger.info("")
+
+        # Search sequences with real-time file writing
+        total_sequences, sequence_timestamps, completed = get_all_user_sequences(
+            username, max_pages, camera_type_filter, f, RateLimiter(args.rps)
+        )
+
+        # Never publish a truncated list as the final file
+        if not completed:
+            print(f"❌ Search did not complete, partial results kept in {tmp_output_file}")
+            return
+
+        if not finalize_output_file(f, output_file):
+            print(f"❌ Error saving output file, partial results kept in {tmp_output_file}")
+            return
+    finally:
+        f.close()
 
     if total_sequences == 0:
         logger.info("No sequences found")
@@ -0,0 +1,231 @@
+"""
+Mapillary API helpers
+Shared helpers for talking to the Mapillary Graph API and image CDN
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # Optional, faster JSON decoding
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Default request budget (requests per second) shared by all workers
+DEFAULT_RPS = 10.0
+
+# The rate limiter never backs off below this many requests per second
+MIN_RPS = 0.5
+
+# Repeated 429s within this many seconds (or the Retry-After delay, if
+# longer) of a backoff only halve the request rate once
+BACKOFF_WINDOW = 1.0
+
+# After a backoff, each successful request raises the rate by this
+# fraction of the configured rate until it is reached again
+RATE_RECOVERY_STEP = 0.05
+
+# Pause all workers once X-RateLimit-Remaining drops to this value
+RATE_LIMIT_LOW_WATERMARK = 5
+
+# Default number of pooled keep-alive connections per host
+DEFAULT_POOL_SIZE = 10
+
+# Connection-level retries (DNS, refused/reset connections, read timeouts).
+# HTTP status retries stay in get_with_retry so 429s reach the rate limiter.
+CONNECTION_RETRIES = 3
+
+
+def create_session(access_token=None, pool_size=DEFAULT_POOL_SIZE):
+    """
+    Create a requests session with keep-alive connection pooling
+
+    Reusing one session avoids a new TCP/TLS handshake for every request.
+    Without an access_token no Authorization header is sent (image CDN).
+    Connection errors are retried by urllib3 with exponential backoff.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=CONNECTION_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(),
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    if access_token:
+        session.headers.update({'Authorization': f'OAuth {access_token}'})
+    return session
+
+
+def parse_json(content):
+    """Decode a JSON response body (bytes), using orjson when installed"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def parse_header_number(response, name):
+    """Return a numeric response header as float, or None if absent/unparseable"""
+    value = response.headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_retry_after(response):
+    """Return the Retry-After header in seconds, or None if absent/unparseable"""
+    value = parse_header_number(response, 'Retry-After')
+    return max(0.0, value) if value is not None else None
+
+
+def get_with_retry(session, url, rate_limiter, max_retries=6, timeout=30, logger=logger, **kwargs):
+    """
+    GET a URL through the rate limiter, retrying on 429 and 5xx responses
+
+    On 429 the server's Retry-After is honoured (exponential backoff if
+    missing) and the shared rate limiter is slowed down, so every worker
+    sends fewer requests afterwards. 5xx responses are retried with
+    jittered exponential backoff. Rate limit headers on every response
+    are fed back into the limiter.
+    """
+    for attempt in range(max_retries):
+        rate_limiter.acquire()
+        response = session.get(url, timeout=timeout, **kwargs)
+        rate_limiter.observe(response)
+
+        if attempt < max_retries - 1:
+            if response.status_code == 429:
+                retry_after = parse_retry_after(response)
+                wait = retry_after if retry_after is not None else 2 ** attempt
+                rate_limiter.backoff(wait)
+                logger.warning(f"Rate limited (429), retrying in {wait:.1f}s "
+                               f"(attempt {attempt + 1}/{max_retries}, now {rate_limiter.rate:g} rps)")
+                response.close()
+                time.sleep(wait)
+                continue
+
+            if response.status_code >= 500:
+                wait = random.uniform(0, 2 ** attempt)
+                logger.warning(f"Server error ({response.status_code}), retrying in {wait:.1f}s "
+                               f"(attempt {attempt + 1}/{max_retries})")
+                response.close()
+                time.sleep(wait)
+                continue
+
+        response.raise_for_status()
+        rate_limiter.record_success()
+        return response
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter shared across threads
+
+    Every API request calls acquire() first; all workers draw from the same
+    bucket, so raising concurrency never raises the overall request rate.
+    """
+
+    def __init__(self, rate_per_sec=DEFAULT_RPS, capacity=None, min_rate=MIN_RPS):
+        if rate_per_sec <= 0:
+            raise ValueError(f"rate_per_sec must be positive, got {rate_per_sec}")
+        self.rate = float(rate_per_sec)
+        self.max_rate = self.rate
+        self.min_rate = min(float(min_rate), self.rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.backoff_until = 0.0  # End of the current backoff window (monotonic)
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Add the tokens earned since the last refill (lock must be held)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def _set_rate(self, rate):
+        """
+        Change the request rate (lock must be held), keeping a pending
+        pause (negative tokens) the same length in seconds
+        """
+        if self.tokens < 0:
+            self.tokens *= rate / self.rate
+        self.rate = rate
+
+    def acquire(self):
+        """Block until a request token is available"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, delay):
+        """
+        Make every worker wait at least `delay` seconds before the next request
+
+        Overlapping pauses do not add up; the later deadline wins.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, -delay * self.rate)
+
+    def backoff(self, delay=0.0):
+        """
+        React to a rate-limit response: halve the request rate and make
+        every worker wait at least `delay` seconds before the next request
+
+        Concurrent 429s from the same burst halve the rate only once, and
+        their delays do not add up; the latest deadline wins.
+        """
+        with self._lock:
+            self._refill()
+            now = self.last_refill
+            if now >= self.backoff_until:
+                self._set_rate(max(self.min_rate, self.rate / 2))
+            self.backoff_until = max(self.backoff_until, now + max(delay, BACKOFF_WINDOW))
+            self.tokens = min(self.tokens, -delay * self.rate)
+
+    def record_success(self):
+        """Raise a backed-off rate step by step toward the configured rate"""
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self._refill()
+            if self.last_refill >= self.backoff_until:
+                self._set_rate(min(self.max_rate, self.rate + self.max_rate * RATE_RECOVERY_STEP))
+
+    def observe(self, response):
+        """
+        Pause all workers when the server reports that its rate limit is
+        almost used up (X-RateLimit-Remaining / X-RateLimit-Reset headers)
+        """
+        remaining = parse_header_number(response, 'X-RateLimit-Remaining')
+        if remaining is None or remaining > RATE_LIMIT_LOW_WATERMARK:
+            return
+
+        reset = parse_header_number(response, 'X-RateLimit-Reset')
+        if reset is None:
+            delay = 1.0
+        elif reset > 1e9:
+            delay = reset - time.time()  # Absolute epoch timestamp
+        else:
+            delay = reset  # Seconds until reset
+        self.pause(max(0.0, delay))
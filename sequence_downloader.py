@@ -1,133 +1,330 @@
-import requests, json, os
+import hashlib, json, os, shutil, sqlite3, struct, time
 from PIL import Image
 import piexif
 from io import BytesIO
-import time
 from datetime import datetime, timezone, timedelta
 import logging
+import logging.handlers
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import NamedTuple
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from mapillary_api import RateLimiter, DEFAULT_RPS, create_session, get_with_retry, parse_json
+
+try:
+    # Optional, real timezones from GPS coordinates instead of longitude / 15
+    from timezonefinder import TimezoneFinder
+    from zoneinfo import ZoneInfo
+except ImportError:
+    TimezoneFinder = None
+
+# Module logger, used by helpers when no per-sequence logger is passed in
+logger = logging.getLogger(__name__)
+
+# Number of images of one sequence processed in parallel by default
+DEFAULT_WORKERS = 8
+
+# Read size when streaming image downloads to disk; large enough that
+# most images are written in a few big writes, small enough to keep
+# memory per in-flight download bounded
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Attempts per image download; covers failures while the body is being
+# read, which the session adapter's connection retries do not
+DOWNLOAD_RETRIES = 3
+
+# Metadata fields read by add_gps_exif_data, in unpacking order
+EXIF_METADATA_KEYS = (
+    'alt', 'captured_at', 'compass_angle', 'camera_make', 'camera_model',
+    'width', 'height', 'focal_length', 'camera_parameters',
+    'iso', 'exposure_time', 'aperture',
+)
+
+# Metadata fields added to the EXIF UserComment, in order, with their
+# formatters (only data without a standard EXIF tag)
+USER_COMMENT_FIELDS = (
+    ('creator_username', 'Creator: {}'.format),
+    ('camera_type', 'Camera Type: {}'.format),
+    ('atomic_scale', 'Atomic Scale: {}'.format),
+    # Only the principal point; the focal length is in the FocalLength tag
+    ('camera_parameters', lambda params: f"Principal Point: [{params[1]:.3f}, {params[2]:.3f}]"),
+    ('mesh', lambda mesh: f"Mesh ID: {mesh['id']}"),
+    ('sfm_cluster', lambda cluster: f"SfM Cluster: {cluster['id']}"),
+)
+
+# Number of image IDs looked up per Graph API ?ids= request
+METADATA_BATCH_SIZE = 50
+
+# 0th IFD tags that are the same for every image; per-image tags are added
+# on top in add_gps_exif_data. 72 DPI is the standard for digital cameras.
+ZEROTH_IFD_TEMPLATE = {
+    piexif.ImageIFD.Software: 'Mapillary Sequence Downloader v5',
+    piexif.ImageIFD.XResolution: (72, 1),
+    piexif.ImageIFD.YResolution: (72, 1),
+    piexif.ImageIFD.ResolutionUnit: 2,  # Inches
+}
+
+# Sequence image lists are cached on disk so re-runs skip the listing request.
+# Published sequences do not change, but the image URLs in the list are
+# signed and eventually expire, so cache entries are only used for a day.
+CACHE_DIR = ".mapillary_cache"
+SEQUENCE_CACHE_TTL = 24 * 60 * 60  # seconds
+
+# Metadata looked up per image (specific images) is cached in SQLite,
+# with the same lifetime as the image lists
+METADATA_CACHE_PATH = os.path.join(CACHE_DIR, "metadata.db")
+
+# timezone objects by whole-hour offset, see get_timezone()
+_timezones = {}
+
+# Coordinates are rounded to this many decimals (~1 km) before the
+# timezone lookup, so all images of a sequence share a cache entry
+TIMEZONE_LOOKUP_PRECISION = 2
+
+# TimezoneFinder instance, created on first use, see find_timezone()
+_timezone_finder = None
+_timezone_finder_lock = threading.Lock()
+
+# Process pool for CPU-bound JPEG encoding, see get_encoder_pool()
+_encoder_pool = None
+_encoder_pool_lock = threading.Lock()
+
+# Image fields requested from the Graph API
+IMAGE_FIELDS = [
+    'thumb_original_url', 'geometry', 'captured_at', 'compass_angle', 'camera_type',
+    'computed_altitude', 'computed_compass_angle', 'sequence', 'camera_parameters',
+    'atomic_scale', 'computed_geometry', 'mesh', 'sfm_cluster'
+]
+IMAGE_FIELDS_PARAM = ','.join(IMAGE_FIELDS)
+
 
 # Setup logging
-def setup_logging(sequence_id):
-    """Setup logging to both console and file"""
+def setup_logging(sequence_id, level=logging.INFO):
+    """
+    Setup a per-sequence logger writing to both console and file
+
+    The calling (worker) thread merges each record's message and arguments
+    (QueueHandler.prepare) and queues it; a QueueListener thread adds the
+    timestamp/level formatting and does the file/console writes.
+    Debug messages are only formatted and written with level=logging.DEBUG
+    (--verbose).
+    """
     # Create logs directory
-    if not os.path.exists("logs"):
-        os.makedirs("logs")
+    os.makedirs("logs", exist_ok=True)
 
     # Generate log filename
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     log_filename = f"logs/sequence_{sequence_id}_{timestamp}.log"
 
     # Setup log format
-    log_format = '%(asctime)s - %(levelname)s - %(message)s'
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+    # Use a dedicated logger per sequence so concurrent downloads
+    # (see batch_downloader.py) don't write into each other's log files
+    seq_logger = logging.getLogger(f"{__name__}.{sequence_id}")
+    seq_logger.setLevel(level)
+    seq_logger.propagate = False
 
     # Clear existing handlers
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-
-    # Configure root logger
-    logging.basicConfig(
-        level=logging.INFO,
-        format=log_format,
-        handlers=[
-            logging.FileHandler(log_filename, encoding='utf-8'),
-            logging.StreamHandler()  # Also output to console
-        ]
-    )
+    close_logging(seq_logger)
+
+    file_handler = logging.FileHandler(log_filename, encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler()  # Also output to console
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+    queue_handler.listener.start()
+    seq_logger.addHandler(queue_handler)
+
+    seq_logger.info(f"Starting download for sequence {sequence_id}")
+    seq_logger.info(f"Log file: {log_filename}")
+    return seq_logger, log_filename
+
+
+def close_logging(seq_logger):
+    """Detach and close all handlers of a per-sequence logger"""
+    for handler in seq_logger.handlers[:]:
+        seq_logger.removeHandler(handler)
+        listener = getattr(handler, 'listener', None)
+        if listener is not None:
+            # Write out the queued records, then close the file/console handlers
+            listener.stop()
+            for target in listener.handlers:
+                target.close()
+        handler.close()
+
+
+def convert_to_dms(value):
+    """
+    Convert decimal degrees to EXIF degree/minute/second rationals
 
-    logger = logging.getLogger(__name__)
-    logger.info(f"Starting download for sequence {sequence_id}")
-    logger.info(f"Log file: {log_filename}")
-    return logger, log_filename
+    Uses integer arithmetic on micro-arcseconds, so there is no float
+    rounding drift; seconds keep microsecond precision. The sign is
+    dropped (it goes into the N/S or E/W reference tag).
+    """
+    micro_arcsec = round(abs(value) * 3_600_000_000)
+    degrees, rem = divmod(micro_arcsec, 3_600_000_000)
+    minutes, micro_sec = divmod(rem, 60_000_000)
+    return [(degrees, 1), (minutes, 1), (micro_sec, 1_000_000)]
+
+class CaptureInfo(NamedTuple):
+    """Capture time of an image, derived once by derive_capture_times"""
+    local: datetime  # In the timezone estimated from the GPS position
+    utc: datetime
+    tz_offset: int  # UTC offset at capture time in minutes
+    filename_stem: str  # YYYYMMDD_HHMMSS_mmm in the longitude-estimated local time
+
+def get_timezone(tz_offset):
+    """Return a (cached) fixed-offset timezone for a whole-hour UTC offset"""
+    tz = _timezones.get(tz_offset)
+    if tz is None:
+        tz = timezone(timedelta(hours=tz_offset)) if tz_offset else timezone.utc
+        _timezones[tz_offset] = tz
+    return tz
+
+@lru_cache(maxsize=256)
+def find_timezone(latitude, longitude):
+    """
+    Return the IANA timezone at a (rounded) position, or None
 
-logger = None  # Will be initialized in main function
+    Needs the optional timezonefinder package; returns None without it or
+    when the position has no timezone (e.g. open sea).
+    """
+    global _timezone_finder
+    if TimezoneFinder is None:
+        return None
+    with _timezone_finder_lock:
+        if _timezone_finder is None:
+            _timezone_finder = TimezoneFinder()
+        name = _timezone_finder.timezone_at(lat=latitude, lng=longitude)
+    if name is None:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (KeyError, ValueError):  # ZoneInfoNotFoundError is a KeyError
+        return None
+
+def format_utc_offset(minutes):
+    """Format a UTC offset in minutes as +HH:MM / -HH:MM"""
+    sign = '+' if minutes >= 0 else '-'
+    hours, minutes = divmod(abs(minutes), 60)
+    return f"{sign}{hours:02d}:{minutes:02d}"
+
+def derive_capture_times(img_data, logger=logger):
+    """
+    Derive the local and UTC capture time of an image
 
+    Mapillary timestamp is in local timezone; the timezone is looked up
+    from the GPS position (original geometry, computed geometry as a
+    fallback) with timezonefinder if installed, otherwise roughly
+    estimated from the longitude. The local time goes into EXIF.
 
-def add_gps_exif_data(latitude, longitude, image_id, sequence_id=None, image_metadata=None):
+    Folder names and filenames (filename_stem) always use the longitude
+    estimate, so installing timezonefinder does not rename the output of
+    earlier runs and resuming still finds it. Returns None if the image
+    has no captured_at.
+    """
+    captured_at = img_data.get('captured_at')
+    if not captured_at:
+        return None
+
+    tz = name_tz = timezone.utc
+    for key in ('geometry', 'computed_geometry'):
+        geometry = img_data.get(key)
+        coords = geometry.get('coordinates') if geometry else None
+        if coords and len(coords) >= 2:
+            longitude, latitude = coords[0], coords[1]
+            name_tz = get_timezone(int(longitude / 15))  # Rough timezone calculation
+            tz = find_timezone(round(latitude, TIMEZONE_LOOKUP_PRECISION),
+                               round(longitude, TIMEZONE_LOOKUP_PRECISION)) or name_tz
+            break
+
+    capture_utc = datetime.fromtimestamp(captured_at / 1000.0, tz=timezone.utc)
+    capture_local = capture_utc.astimezone(tz)
+    tz_offset = int(capture_local.utcoffset().total_seconds()) // 60
+    name_time = capture_utc.astimezone(name_tz)
+    filename_stem = f"{name_time.strftime('%Y%m%d_%H%M%S')}_{name_time.microsecond // 1000:03d}"
+    logger.debug("Capture time - captured_at: %s, timezone offset: %d min, local: %s",
+                 captured_at, tz_offset, capture_local)
+    return CaptureInfo(capture_local, capture_utc, tz_offset, filename_stem)
+
+def add_gps_exif_data(latitude, longitude, image_id, sequence_id=None, image_metadata=None,
+                      capture=None, download_time=None, logger=logger):
     """
     Add comprehensive GPS and EXIF data to image
+
+    capture is the image's CaptureInfo; if None it is derived from
+    image_metadata. download_time is the "Downloaded" string for the
+    UserComment; main() formats it once per sequence. If None, the
+    current time is used.
     """
-    def convert_to_degrees(value):
-        d = int(value)
-        m = int((value - d) * 60)
-        s = (value - d - m/60) * 3600
-        return d, m, s
+    lat_dms = convert_to_dms(latitude)
+    lon_dms = convert_to_dms(longitude)
 
-    lat_deg = convert_to_degrees(abs(latitude))
-    lon_deg = convert_to_degrees(abs(longitude))
+    # Read every metadata field used below once
+    metadata = image_metadata or {}
+    (alt, original_captured_at, compass_angle, camera_make, camera_model,
+     image_width, image_height, focal_length, camera_parameters,
+     iso, exposure_time, aperture) = map(metadata.get, EXIF_METADATA_KEYS)
 
     # GPS information - only use original data, avoid computed values
     altitude = None
     # Only use original alt, remove all computed_* altitude fields
-    if image_metadata and image_metadata.get('alt'):
-        altitude = max(0, int(image_metadata['alt'] * 100))  # Ensure non-negative
+    if alt:
+        altitude = max(0, int(alt * 100))  # Ensure non-negative
 
     # Use captured_at timestamp if available
-    capture_time = datetime.now()
+    if capture is None:
+        capture = derive_capture_times(metadata, logger=logger)
 
-    if image_metadata and image_metadata.get('captured_at'):
+    if capture is not None:
         # Log original captured_at value for debugging
-        original_captured_at = image_metadata['captured_at']
-        logger.debug(f"Original captured_at: {original_captured_at} (type: {type(original_captured_at)})")
-
-        # Try to infer timezone from GPS coordinates
-        if latitude and longitude:
-            try:
-                # Simple timezone inference based on longitude
-                # This is a rough approximation - in practice you'd use a proper timezone library
-                tz_offset = int(longitude / 15)  # Rough timezone calculation
-                logger.debug(f"GPS coordinates: lat={latitude}, lon={longitude}")
-                logger.debug(f"Calculated timezone offset: {tz_offset} hours")
-                logger.info(f"Inferred timezone offset from GPS: UTC{tz_offset:+d}")
-            except Exception as e:
-                tz_offset = 0
-                logger.warning(f"Could not infer timezone from GPS: {e}, using UTC")
-        else:
-            tz_offset = 0
-            logger.warning("No GPS coordinates available, using UTC")
-
-        # Convert timestamp to seconds and log
-        timestamp_sec = original_captured_at / 1000.0
-        logger.debug(f"Timestamp in seconds: {timestamp_sec}")
-        logger.debug(f"Unix timestamp: {int(timestamp_sec)}")
+        logger.debug("Original captured_at: %s (type: %s)", original_captured_at, type(original_captured_at))
 
         # Mapillary timestamp is in local timezone, use local time for EXIF DateTime tags
-        if tz_offset != 0:
-            tz = timezone(timedelta(hours=tz_offset))
-            capture_time = datetime.fromtimestamp(timestamp_sec, tz=tz)  # Use local time for EXIF
-            capture_time_utc = capture_time.astimezone(timezone.utc)  # Keep UTC for GPS timestamp
-            logger.debug(f"Local timezone: {tz}")
-            logger.debug(f"Local time (for EXIF): {capture_time}")
-            logger.debug(f"UTC time (for GPS): {capture_time_utc}")
-            logger.info(f"Mapillary local time: {capture_time.strftime('%Y-%m-%d %H:%M:%S %Z')} -> UTC: {capture_time_utc.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-        else:
+        capture_time = capture.local
+        capture_time_utc = capture.utc  # Keep UTC for GPS timestamp
+        if capture.tz_offset != 0:
+            logger.info("Inferred timezone offset from GPS: UTC%s", format_utc_offset(capture.tz_offset))
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Mapillary local time: %s -> UTC: %s",
+                            capture_time.strftime('%Y-%m-%d %H:%M:%S %Z'),
+                            capture_time_utc.strftime('%Y-%m-%d %H:%M:%S %Z'))
+        elif logger.isEnabledFor(logging.INFO):
             # Assume UTC if no timezone info
-            capture_time = datetime.fromtimestamp(timestamp_sec, tz=timezone.utc)
-            capture_time_utc = capture_time
-            logger.debug(f"Using UTC timezone (no GPS timezone inference)")
-            logger.debug(f"UTC time: {capture_time}")
-            logger.info(f"Mapillary timestamp (UTC): {capture_time.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+            logger.info("Mapillary timestamp (UTC): %s", capture_time.strftime('%Y-%m-%d %H:%M:%S %Z'))
+    else:
+        # No capture time in the metadata, fall back to the current time
+        capture_time = capture_time_utc = datetime.now(timezone.utc)
+        logger.warning("No captured_at available, using the current time")
 
     # Convert to UTC for GPS timestamp (keep original EXIF behavior)
     gps_time = capture_time_utc.utctimetuple()
 
     gps_ifd = {
         piexif.GPSIFD.GPSLatitudeRef: 'N' if latitude >= 0 else 'S',
-        piexif.GPSIFD.GPSLatitude: [(lat_deg[0], 1), (lat_deg[1], 1), (int(lat_deg[2]*100), 100)],
+        piexif.GPSIFD.GPSLatitude: lat_dms,
         piexif.GPSIFD.GPSLongitudeRef: 'E' if longitude >= 0 else 'W',
-        piexif.GPSIFD.GPSLongitude: [(lon_deg[0], 1), (lon_deg[1], 1), (int(lon_deg[2]*100), 100)],
+        piexif.GPSIFD.GPSLongitude: lon_dms,
         piexif.GPSIFD.GPSTimeStamp: [(gps_time.tm_hour, 1), (gps_time.tm_min, 1), (gps_time.tm_sec, 1)],
         piexif.GPSIFD.GPSDateStamp: capture_time_utc.strftime('%Y:%m:%d')
     }
 
     # Only use original compass angle, avoid computed values
-    if image_metadata and image_metadata.get('compass_angle'):
-        compass_angle = image_metadata['compass_angle']
+    if compass_angle:
         gps_ifd[piexif.GPSIFD.GPSImgDirection] = (int(compass_angle * 100), 100)
         gps_ifd[piexif.GPSIFD.GPSImgDirectionRef] = 'T'  # True direction
 
     # Add original compass angle as additional info (not used for main direction)
-    # if image_metadata and image_metadata.get('compass_angle'):
-    #     compass_angle = image_metadata['compass_angle']
+    # if compass_angle:
     #     gps_ifd[piexif.GPSIFD.GPSDestBearing] = (int(compass_angle * 100), 100)
     #     gps_ifd[piexif.GPSIFD.GPSDestBearingRef] = 'T'  # True direction
 
@@ -136,21 +333,6 @@ def add_gps_exif_data(latitude, longitude, image_id, sequence_id=None, image_met
         gps_ifd[piexif.GPSIFD.GPSAltitudeRef] = 0  # Above sea level
         gps_ifd[piexif.GPSIFD.GPSAltitude] = (altitude, 100)
 
-    # Basic image information - only use if available from metadata
-    camera_make = None
-    camera_model = None
-
-    if image_metadata:
-        camera_make = image_metadata.get('camera_make')
-        camera_model = image_metadata.get('camera_model')
-
-    # Get image dimensions - only use if available from metadata
-    image_width = None
-    image_height = None
-    if image_metadata:
-        image_width = image_metadata.get('width')
-        image_height = image_metadata.get('height')
-
     # Determine image orientation based on dimensions
     # 1 = normal, 3 = 180°, 6 = 90° clockwise, 8 = 90° counter-clockwise
     orientation = 1  # default normal orientation
@@ -160,15 +342,12 @@ def add_gps_exif_data(latitude, longitude, image_id, sequence_id=None, image_met
         else:
             orientation = 6  # portrait (90° clockwise)
 
-    # Use standard DPI for digital images (72 DPI is the standard for digital cameras)
-    dpi = 72
+    # Format the capture time once (with milliseconds) for all DateTime tags
+    capture_time_str = capture_time.strftime('%Y:%m:%d %H:%M:%S.%f')[:-3]
 
     zeroth_ifd = {
-        piexif.ImageIFD.Software: 'Mapillary Sequence Downloader v5',
-        piexif.ImageIFD.DateTime: capture_time.strftime('%Y:%m:%d %H:%M:%S'),
-        piexif.ImageIFD.XResolution: (dpi, 1),
-        piexif.ImageIFD.YResolution: (dpi, 1),
-        piexif.ImageIFD.ResolutionUnit: 2,  # Inches
+        **ZEROTH_IFD_TEMPLATE,
+        piexif.ImageIFD.DateTime: capture_time_str[:19],
         piexif.ImageIFD.Orientation: orientation,
     }
 
@@ -180,20 +359,18 @@ def add_gps_exif_data(latitude, longitude, image_id, sequence_id=None, image_met
 
     # Camera information (with microsecond precision)
     exif_ifd = {
-        piexif.ExifIFD.DateTimeOriginal: capture_time.strftime('%Y:%m:%d %H:%M:%S.%f')[:-3],  # Keep milliseconds
-        piexif.ExifIFD.DateTimeDigitized: capture_time.strftime('%Y:%m:%d %H:%M:%S.%f')[:-3],  # Keep milliseconds
+        piexif.ExifIFD.DateTimeOriginal: capture_time_str,  # Keep milliseconds
+        piexif.ExifIFD.DateTimeDigitized: capture_time_str,  # Keep milliseconds
     }
 
     # Add timezone offset information (EXIF 2.31)
-    if image_metadata and image_metadata.get('captured_at') and latitude and longitude:
+    if capture is not None:
         try:
-            # Calculate timezone offset from GPS coordinates
-            tz_offset = int(longitude / 15)  # Rough timezone calculation
+            tz_offset = capture.tz_offset
             if tz_offset != 0:
                 # Format timezone offset as +HH:MM or -HH:MM
-                offset_hours = abs(tz_offset)
-                offset_str = f"{'+' if tz_offset >= 0 else '-'}{offset_hours:02d}:00"
-                logger.debug(f"Adding timezone offset tags: {offset_str}")
+                offset_str = format_utc_offset(tz_offset)
+                logger.debug("Adding timezone offset tags: %s", offset_str)
 
                 # Add timezone offset tags (EXIF 2.31)
                 # Note: These tags might not be available in older piexif versions
@@ -201,40 +378,39 @@ def add_gps_exif_data(latitude, longitude, image_id, sequence_id=None, image_met
                     exif_ifd[0x9010] = offset_str  # OffsetTime
                     exif_ifd[0x9011] = offset_str  # OffsetTimeOriginal
                     exif_ifd[0x9012] = offset_str  # OffsetTimeDigitized
-                    logger.debug(f"Timezone offset tags added: {offset_str}")
+                    logger.debug("Timezone offset tags added: %s", offset_str)
                 except Exception as tag_error:
-                    logger.warning(f"Timezone offset tags not supported in this piexif version: {tag_error}")
+                    logger.warning("Timezone offset tags not supported in this piexif version: %s", tag_error)
         except Exception as e:
-            logger.warning(f"Failed to add timezone offset tags: {e}")
+            logger.warning("Failed to add timezone offset tags: %s", e)
 
     # Add camera settings if available from metadata
-    if image_metadata:
-        # Add focal length if available
-        if image_metadata.get('focal_length'):
-            exif_ifd[piexif.ExifIFD.FocalLength] = (int(image_metadata['focal_length'] * 100), 100)
-
-        # Calculate focal length from camera_parameters if available
-        elif image_metadata.get('camera_parameters') and image_width and image_height:
-            # camera_parameters[0] is focal length in relative units
-            # Convert to pixels: focal_length_pixels = relative_focal_length * max(width, height)
-            relative_focal_length = image_metadata['camera_parameters'][0]
-            focal_length_pixels = relative_focal_length * max(image_width, image_height)
-            # Convert to mm (assuming 35mm equivalent sensor)
-            # This is an approximation - actual conversion depends on sensor size
-            focal_length_mm = focal_length_pixels * 0.036  # 36mm sensor width approximation
-            exif_ifd[piexif.ExifIFD.FocalLength] = (int(focal_length_mm * 100), 100)
-
-        # Add ISO if available
-        if image_metadata.get('iso'):
-            exif_ifd[piexif.ExifIFD.ISOSpeedRatings] = image_metadata['iso']
-
-        # Add exposure time if available
-        if image_metadata.get('exposure_time'):
-            exif_ifd[piexif.ExifIFD.ExposureTime] = (int(image_metadata['exposure_time'] * 1000000), 1000000)
-
-        # Add aperture if available
-        if image_metadata.get('aperture'):
-            exif_ifd[piexif.ExifIFD.FNumber] = (int(image_metadata['aperture'] * 100), 100)
+    # Add focal length if available
+    if focal_length:
+        exif_ifd[piexif.ExifIFD.FocalLength] = (int(focal_length * 100), 100)
+
+    # Calculate focal length from camera_parameters if available
+    elif camera_parameters and image_width and image_height:
+        # camera_parameters[0] is focal length in relative units
+        # Convert to pixels: focal_length_pixels = relative_focal_length * max(width, height)
+        relative_focal_length = camera_parameters[0]
+        focal_length_pixels = relative_focal_length * max(image_width, image_height)
+        # Convert to mm (assuming 35mm equivalent sensor)
+        # This is an approximation - actual conversion depends on sensor size
+        focal_length_mm = focal_length_pixels * 0.036  # 36mm sensor width approximation
+        exif_ifd[piexif.ExifIFD.FocalLength] = (int(focal_length_mm * 100), 100)
+
+    # Add ISO if available
+    if iso:
+        exif_ifd[piexif.ExifIFD.ISOSpeedRatings] = iso
+
+    # Add exposure time if available
+    if exposure_time:
+        exif_ifd[piexif.ExifIFD.ExposureTime] = (int(exposure_time * 1000000), 1000000)
+
+    # Add aperture if available
+    if aperture:
+        exif_ifd[piexif.ExifIFD.FNumber] = (int(aperture * 100), 100)
 
     # Add image dimensions if available
     if image_width and image_height and image_width > 0 and image_height > 0:
@@ -245,26 +421,18 @@ def add_gps_exif_data(latitude, longitude, image_id, sequence_id=None, image_met
         zeroth_ifd[piexif.ImageIFD.ImageLength] = image_height
 
     # Add Mapillary-specific information to UserComment (only data without standard EXIF fields)
-    mapillary_info = f"Mapillary Image ID: {image_id}"
+    comment_parts = [f"Mapillary Image ID: {image_id}"]
     if sequence_id:
-        mapillary_info += f" | Sequence: {sequence_id}"
-    if image_metadata and image_metadata.get('creator_username'):
-        mapillary_info += f" | Creator: {image_metadata['creator_username']}"
-    if image_metadata and image_metadata.get('camera_type'):
-        mapillary_info += f" | Camera Type: {image_metadata['camera_type']}"
-    if image_metadata and image_metadata.get('atomic_scale'):
-        mapillary_info += f" | Atomic Scale: {image_metadata['atomic_scale']}"
-    if image_metadata and image_metadata.get('camera_parameters'):
-        params = image_metadata['camera_parameters']
-        # Only include principal point parameters (not focal length as it's now in EXIF)
-        mapillary_info += f" | Principal Point: [{params[1]:.3f}, {params[2]:.3f}]"
-    if image_metadata and image_metadata.get('mesh'):
-        mapillary_info += f" | Mesh ID: {image_metadata['mesh']['id']}"
-    if image_metadata and image_metadata.get('sfm_cluster'):
-        mapillary_info += f" | SfM Cluster: {image_metadata['sfm_cluster']['id']}"
-    mapillary_info += f" | Downloaded: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-
-    exif_ifd[piexif.ExifIFD.UserComment] = mapillary_info.encode('utf-8')
+        comment_parts.append(f"Sequence: {sequence_id}")
+    for key, format_field in USER_COMMENT_FIELDS:
+        value = metadata.get(key)
+        if value:
+            comment_parts.append(format_field(value))
+    if download_time is None:
+        download_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    comment_parts.append(f"Downloaded: {download_time}")
+
+    exif_ifd[piexif.ExifIFD.UserComment] = " | ".join(comment_parts).encode('utf-8')
 
     exif_dict = {
         "0th": zeroth_ifd,
@@ -292,277 +460,710 @@ def add_gps_exif_data(latitude, longitude, image_id, sequence_id=None, image_met
             'exif_ifd_size': len(exif_ifd)
         }
 
-        logger.warning(f"Failed to create EXIF data for image {image_id}: {e}")
-        logger.debug(f"Error details: {error_details}")
+        logger.warning("Failed to create EXIF data for image %s: %s", image_id, e)
+        logger.debug("Error details: %s", error_details)
         return None
 
 
-def download_image_with_retry(url, max_retries=3):
+def download_image_to(url, path, session, rate_limiter, write_body=None,
+                      max_retries=DOWNLOAD_RETRIES, logger=logger):
     """
-    Download image with retry mechanism
+    Download an image straight to a file
+
+    The body is streamed in DOWNLOAD_CHUNK_SIZE chunks, so memory use does
+    not grow with the image size. write_body(source, f), if given, copies
+    the response body to the open file instead (see copy_jpeg_with_exif);
+    its result is returned. Connection errors are retried by the
+    session's adapter, 429/5xx responses by get_with_retry. A connection
+    that breaks or times out while the body is read is retried here with
+    exponential backoff; the file is rewritten from the start.
     """
     for attempt in range(max_retries):
         try:
-            response = requests.get(url, stream=True, timeout=30)
-            response.raise_for_status()
-            return response.content
-        except Exception as e:
-            logger.warning(f"Failed to download image (attempt {attempt + 1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)  # Exponential backoff
-            else:
-                raise e
-
-def main(sequence_id, quality=None, specific_images=None):
+            response = get_with_retry(session, url, rate_limiter, logger=logger, stream=True)
+            with response:
+                response.raw.decode_content = True
+                with open(path, 'wb') as f:
+                    if write_body is not None:
+                        return write_body(response.raw, f)
+                    shutil.copyfileobj(response.raw, f, DOWNLOAD_CHUNK_SIZE)
+            return None
+        except requests.HTTPError:
+            raise  # Status errors were already retried by get_with_retry
+        except (requests.RequestException, ProtocolError, ReadTimeoutError) as e:
+            if attempt == max_retries - 1:
+                raise
+            logger.warning("Failed to download image (attempt %d/%d): %s", attempt + 1, max_retries, e)
+            time.sleep(2 ** attempt)  # Exponential backoff
+
+def fetch_image_metadata(image_id, session, rate_limiter, logger=logger):
     """
-    Main function to download all images in a sequence or specific images
+    Get comprehensive image information with additional fields
+    """
+    image_url = f"https://graph.mapillary.com/{image_id}?fields={IMAGE_FIELDS_PARAM}"
+    img_r = get_with_retry(session, image_url, rate_limiter, logger=logger)
+    return parse_json(img_r.content)
 
-    Args:
-        sequence_id (str): Sequence ID to download
-        quality (int, optional): JPEG quality (1-100). If None, saves original quality
-        specific_images (list, optional): List of specific image IDs to download. If None, downloads all images
+def fetch_images_metadata(image_ids, session, rate_limiter, on_batch=None, logger=logger):
     """
-    global logger
+    Get image information for many images with one request per
+    METADATA_BATCH_SIZE IDs (Graph API ?ids= lookup)
 
-    # Setup logging
-    logger, log_filename = setup_logging(sequence_id)
+    Returns a dict mapping image ID to its metadata. Images missing from
+    the response are left out, so callers can fall back to
+    fetch_image_metadata for them. on_batch, if given, is called with each
+    batch's results as soon as they arrive (e.g. to cache them).
+    """
+    metadata_by_id = {}
+    for start in range(0, len(image_ids), METADATA_BATCH_SIZE):
+        batch = image_ids[start:start + METADATA_BATCH_SIZE]
+        url = f"https://graph.mapillary.com/?ids={','.join(batch)}&fields=id,{IMAGE_FIELDS_PARAM}"
+        r = get_with_retry(session, url, rate_limiter, logger=logger)
+        batch_metadata = parse_json(r.content)
+        if on_batch is not None:
+            on_batch(batch_metadata)
+        metadata_by_id.update(batch_metadata)
+    return metadata_by_id
+
+def fetch_sequence_images(sequence_id, session, rate_limiter, logger=logger):
+    """
+    Get all images of a sequence, requesting the image fields in the same
+    call so no per-image metadata request is needed. Follows paging.next
+    if the response is paginated.
+    """
+    url = f"https://graph.mapillary.com/image_ids?sequence_id={sequence_id}&fields=id,{IMAGE_FIELDS_PARAM}"
+    images = []
+    while url:
+        r = get_with_retry(session, url, rate_limiter, logger=logger)
+        data = parse_json(r.content)
+        images.extend(data.get("data", []))
+        url = data.get("paging", {}).get("next")
+    return images
+
+def image_fields_key():
+    """Short hash of IMAGE_FIELDS, so cache entries from other field sets are not used"""
+    return hashlib.sha1(IMAGE_FIELDS_PARAM.encode('utf-8')).hexdigest()[:8]
+
+def sequence_cache_path(sequence_id):
+    """Cache file for a sequence's image list, keyed by the requested fields"""
+    return os.path.join(CACHE_DIR, f"sequence_{sequence_id}_{image_fields_key()}.json")
+
+def load_cached_sequence_images(sequence_id, logger=logger):
+    """Return the cached image list of a sequence, or None if missing or expired"""
+    path = sequence_cache_path(sequence_id)
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if age > SEQUENCE_CACHE_TTL:
+            logger.debug("Image list cache expired (%.0fs old): %s", age, path)
+            return None
+        with open(path, 'rb') as f:
+            return parse_json(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️  Ignoring unreadable image list cache {path}: {e}")
+        return None
 
-    # Get access_token from config file
+def save_cached_sequence_images(sequence_id, images, logger=logger):
+    """Store a sequence's image list in the cache (written atomically)"""
+    path = sequence_cache_path(sequence_id)
     try:
-        from config import access_token
-    except ImportError:
-        logger.error("❌ config.py file not found!")
-        logger.error("Please create config.py file and set your access_token")
-        logger.error("You can copy config.example.py to config.py as a template")
-        exit(1)
-
-    if not access_token:
-        logger.error("access_token is required in config.py")
-        exit(1)
-
-    if not sequence_id:
-        logger.error("sequence_id is required")
-        exit(1)
-
-    if not os.path.exists("downloads"):
-        os.makedirs("downloads")
-
-    # Set up common header for API requests
-    header = {'Authorization': f'OAuth {access_token}'}
-
-    # Get image IDs - either all images in sequence or specific images
-    if specific_images:
-        logger.info(f"Using specific images list: {len(specific_images)} images")
-        image_ids = [{'id': img_id} for img_id in specific_images]
-    else:
-        logger.info(f"Getting image list for sequence {sequence_id}...")
-        url = f"https://graph.mapillary.com/image_ids?sequence_id={sequence_id}"
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(images, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"⚠️  Could not cache image list: {e}")
+
+class MetadataCache:
+    """
+    SQLite cache of image metadata keyed by (sequence_id, image_id)
 
-        try:
-            r = requests.get(url, headers=header, timeout=30)
-            r.raise_for_status()
-            data = r.json()
-            image_ids = data.get("data", [])
-            logger.info(f"Found {len(image_ids)} images")
-        except Exception as e:
-            logger.error(f"Failed to get image list: {e}")
-            return
+    Entries older than ttl seconds or fetched with a different IMAGE_FIELDS
+    set are ignored. Safe to share between threads.
+    """
+
+    def __init__(self, path=METADATA_CACHE_PATH, ttl=SEQUENCE_CACHE_TTL):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.fields_key = image_fields_key()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS image_metadata ("
+                "seq TEXT, img TEXT, fields TEXT, metadata_json TEXT, fetched_at REAL, "
+                "PRIMARY KEY (seq, img, fields))"
+            )
 
-    # Determine output directory name based on first image's timestamp
-    output_dir = None
-    first_image_timestamp = None
+    def get_many(self, sequence_id, image_ids):
+        """Return a dict of image ID to cached metadata for the IDs that are cached"""
+        min_fetched_at = time.time() - self.ttl
+        found = {}
+        with self._lock:
+            # Stay below SQLite's limit on the number of query parameters
+            for start in range(0, len(image_ids), 500):
+                batch = image_ids[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT img, metadata_json FROM image_metadata "
+                    f"WHERE seq = ? AND fields = ? AND fetched_at >= ? "
+                    f"AND img IN ({','.join('?' * len(batch))})",
+                    (sequence_id, self.fields_key, min_fetched_at, *batch)
+                ).fetchall()
+                for image_id, metadata_json in rows:
+                    found[image_id] = parse_json(metadata_json)
+        return found
+
+    def put_many(self, sequence_id, metadata_by_id):
+        """Store the metadata of several images in one transaction"""
+        fetched_at = time.time()
+        rows = [
+            (sequence_id, image_id, self.fields_key, json.dumps(metadata), fetched_at)
+            for image_id, metadata in metadata_by_id.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO image_metadata VALUES (?, ?, ?, ?, ?)", rows)
 
-    # Initialize error statistics
-    error_count = 0
-    error_images = []
-    exif_error_count = 0
-    exif_error_images = []
+    def close(self):
+        with self._lock:
+            self._conn.close()
 
-    # Process each image and download
-    for i, img_id in enumerate(image_ids, 1):
-        try:
-            logger.info(f"Processing image {i}/{len(image_ids)}: {img_id['id']}")
+def has_image_metadata(img_data):
+    """Whether an image list entry already carries the fields from IMAGE_FIELDS"""
+    return 'thumb_original_url' in img_data
 
-            # Get comprehensive image information with additional fields
-            fields = [
-                'thumb_original_url', 'geometry', 'captured_at', 'compass_angle', 'camera_type',
-                'computed_altitude', 'computed_compass_angle', 'sequence', 'camera_parameters',
-                'atomic_scale', 'computed_geometry', 'mesh', 'sfm_cluster'
-            ]
-            image_url = f"https://graph.mapillary.com/{img_id['id']}?fields={','.join(fields)}"
-            img_r = requests.get(image_url, headers=header, timeout=30)
-            img_r.raise_for_status()
-            img_data = img_r.json()
-
-            # Set output directory name based on first image's timestamp
-            if output_dir is None:
-                if 'captured_at' in img_data and img_data['captured_at']:
-                    # Determine timezone offset from GPS coordinates
-                    tz_offset = 0
-                    if 'computed_geometry' in img_data and img_data['computed_geometry']:
-                        # Try to infer from GPS coordinates
-                        coords = img_data['computed_geometry']['coordinates']
-                        if coords and len(coords) >= 2:
-                            longitude = coords[0]
-                            tz_offset = int(longitude / 15)  # Rough timezone calculation
-
-                    # Mapillary timestamp is in local timezone, keep as local time for folder naming
-                    timestamp_sec = img_data['captured_at'] / 1000.0
-                    logger.debug(f"Folder naming - Original captured_at: {img_data['captured_at']}")
-                    logger.debug(f"Folder naming - Timestamp in seconds: {timestamp_sec}")
-                    logger.debug(f"Folder naming - Timezone offset: {tz_offset}")
-
-                    if tz_offset != 0:
-                        tz = timezone(timedelta(hours=tz_offset))
-                        first_image_timestamp = datetime.fromtimestamp(timestamp_sec, tz=tz)
-                        logger.debug(f"Folder naming - Using GPS timezone: {tz}")
-                    else:
-                        # If no timezone info, use local system timezone
-                        first_image_timestamp = datetime.fromtimestamp(timestamp_sec)
-                        logger.debug(f"Folder naming - Using system timezone")
-
-                    logger.debug(f"Folder naming - Local timestamp: {first_image_timestamp}")
-                    # Create folder name with local date and time
-                    folder_name = f"{first_image_timestamp.strftime('%Y%m%d_%H%M%S')}_{sequence_id[:8]}"
-                    logger.debug(f"Folder naming - Generated folder name: {folder_name}")
-                else:
-                    # Fallback to sequence ID if no timestamp
-                    folder_name = sequence_id
-                output_dir = f"downloads/{folder_name}"
-                if not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
-                    logger.info(f"Created output directory: {output_dir}")
-
-            # Download image
-            image_get_url = img_data['thumb_original_url']
-            logger.debug(f"Downloading image...")
-            image_data = download_image_with_retry(image_get_url)
-
-            # Process image and add EXIF data
-            image = Image.open(BytesIO(image_data))
-
-            # Get actual image dimensions from the downloaded image
-            actual_width, actual_height = image.size
-            logger.info(f"Image dimensions: {actual_width}x{actual_height}")
-
-            # Update image metadata with actual dimensions
-            img_data['width'] = actual_width
-            img_data['height'] = actual_height
-
-            # Force use original geometry coordinates, avoid computed drift issues
-            if 'geometry' in img_data and img_data['geometry']:
-                coords = img_data['geometry']['coordinates']
-            else:
-                logger.error("❌ No available original coordinate information")
+def get_output_dir(sequence_id, img_data, logger=logger):
+    """
+    Output directory name based on the first image's timestamp
+    """
+    capture = derive_capture_times(img_data, logger=logger)
+    if capture is not None:
+        # Create folder name with the local date and time used for filenames
+        folder_name = f"{capture.filename_stem[:15]}_{sequence_id[:8]}"
+        logger.debug("Folder naming - Generated folder name: %s", folder_name)
+    else:
+        # Fallback to sequence ID if no timestamp
+        folder_name = sequence_id
+    return f"downloads/{folder_name}"
+
+def read_jpeg_size(path):
+    """
+    Read (width, height) from a JPEG's SOF marker without decoding it
+
+    Walks the marker segments from the start of the file and seeks past
+    each one, so only a few small reads are needed even when large EXIF
+    or ICC segments come first. Returns None if the file is not a JPEG
+    or no SOF marker is found before the image data.
+    """
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            code = marker[1]
+            if code == 0xFF:
+                # Fill byte before a marker
+                f.seek(-1, os.SEEK_CUR)
+                continue
+            if code == 0xD8 or code == 0x01 or 0xD0 <= code <= 0xD7:
+                # Markers without a length field
                 continue
+            if code == 0xDA or code == 0xD9:
+                # Start of scan / end of image: no SOF found
+                return None
+            header = f.read(2)
+            if len(header) < 2:
+                return None
+            (length,) = struct.unpack('>H', header)
+            # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+            if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                sof = f.read(5)
+                if len(sof) < 5:
+                    return None
+                height, width = struct.unpack('>xHH', sof)
+                return width, height
+            f.seek(length - 2, os.SEEK_CUR)
+
+def read_exact(source, size):
+    """Read exactly size bytes from a stream, raising ValueError if it ends first"""
+    data = source.read(size)
+    while len(data) < size:
+        chunk = source.read(size - len(data))
+        if not chunk:
+            raise ValueError("Unexpected end of JPEG data")
+        data += chunk
+    return data
+
+def copy_jpeg_with_exif(source, f, make_exif):
+    """
+    Copy a JPEG stream to f, replacing its EXIF data on the way
+
+    The marker segments before the frame header (SOF) are read into memory
+    (a few KB, at most some 64 KB segments), which gives the image size
+    without decoding. make_exif(size) is then called with (width, height),
+    or None if there is no SOF before the image data, and returns the EXIF
+    bytes to insert or None to copy the JPEG unchanged. As with
+    piexif.insert, the new EXIF APP1 segment follows SOI and the APP0
+    (JFIF) and old EXIF APP1 segments are dropped. The rest of the stream
+    is copied in DOWNLOAD_CHUNK_SIZE chunks. Returns the EXIF bytes.
+    """
+    if read_exact(source, 2) != b'\xff\xd8':
+        raise ValueError("Not a JPEG image")
+    segments = []
+    size = None
+    while size is None:
+        marker = read_exact(source, 2)
+        while marker[1] == 0xFF:
+            # Fill byte before a marker
+            marker = b'\xff' + read_exact(source, 1)
+        if marker[0] != 0xFF:
+            raise ValueError("Invalid JPEG marker")
+        code = marker[1]
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            # Markers without a length field
+            segments.append((code, marker))
+            continue
+        if code == 0xDA or code == 0xD9:
+            # Start of scan / end of image: no SOF found, copy the rest as is
+            segments.append((code, marker))
+            break
+        header = read_exact(source, 2)
+        (length,) = struct.unpack('>H', header)
+        payload = read_exact(source, length - 2)
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>xHH', payload[:5])
+            size = (width, height)
+        segments.append((code, marker + header + payload))
+
+    exif_bytes = make_exif(size)
+    f.write(b'\xff\xd8')
+    if exif_bytes:
+        f.write(b'\xff\xe1' + struct.pack('>H', len(exif_bytes) + 2))
+        f.write(exif_bytes)
+    for code, segment in segments:
+        if exif_bytes and (code == 0xE0 or (code == 0xE1 and segment[4:10] == b'Exif\x00\x00')):
+            continue
+        f.write(segment)
+    shutil.copyfileobj(source, f, DOWNLOAD_CHUNK_SIZE)
+    return exif_bytes
+
+def get_image_filename(image_id, capture):
+    """
+    Filename based on capture time (use local time for filename only)
+    """
+    if capture is not None:
+        return f"{capture.filename_stem}.jpg"
+    return f"{image_id}.jpg"
+
+def save_image(source_path, output_path, exif_bytes=None, quality=None):
+    """
+    Decode the downloaded JPEG and re-encode it with EXIF data and quality
 
-            # Add comprehensive GPS EXIF data
-            exif_bytes = add_gps_exif_data(
+    Only used when a quality is requested. CPU bound; called in the encoder
+    process pool (see get_encoder_pool). The JPEG is encoded into memory
+    and written with a single write instead of PIL's many small ones.
+    """
+    save_kwargs = {}
+    if exif_bytes:
+        save_kwargs['exif'] = exif_bytes
+    if quality is not None:
+        save_kwargs['quality'] = quality
+    buffer = BytesIO()
+    with Image.open(source_path) as image:
+        image.save(buffer, 'JPEG', **save_kwargs)
+    # Move into place only once complete, so an interrupted run never
+    # leaves a truncated file that would be skipped on resume
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(buffer.getbuffer())
+    os.replace(tmp_path, output_path)
+
+def get_encoder_pool():
+    """
+    Process pool for JPEG encoding, shared by all sequences and workers
+
+    Created on first use so importing this module stays cheap. Worker
+    processes are spawned, not forked: the pool is created while download
+    and logging threads are running, and a forked child could inherit a
+    lock held by one of them and deadlock.
+    """
+    global _encoder_pool
+    with _encoder_pool_lock:
+        if _encoder_pool is None:
+            _encoder_pool = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return _encoder_pool
+
+def encode_image(source_path, output_path, exif_bytes, quality, logger=logger):
+    """
+    Run save_image in the encoder process pool
+
+    If a worker process died, the pool is broken for good; it is replaced
+    and the image is encoded once more.
+    """
+    global _encoder_pool
+    for attempt in range(2):
+        pool = get_encoder_pool()
+        try:
+            return pool.submit(save_image, source_path, output_path, exif_bytes, quality).result()
+        except BrokenProcessPool:
+            with _encoder_pool_lock:
+                if _encoder_pool is pool:
+                    _encoder_pool = None
+            pool.shutdown(wait=False)
+            if attempt:
+                raise
+            logger.warning("Encoder process pool broke, restarting it")
+
+def process_image(i, total, image_id, img_data, output_dir, sequence_id, quality,
+                  api_session, image_session, rate_limiter, existing_files=frozenset(),
+                  download_time=None, stop_event=None, logger=logger):
+    """
+    Download one image, add EXIF data and save it
+
+    Runs in a worker thread. img_data may be None, in which case the
+    metadata is fetched first. Images whose filename is in existing_files
+    are skipped without downloading, and nothing is done once stop_event
+    is set. Returns a dict with an 'error' record (download/processing
+    failure) and/or an 'exif_error' record, both None on success, and
+    'skipped' and 'stopped' flags.
+    """
+    result = {'error': None, 'exif_error': None, 'skipped': False, 'stopped': False}
+    if stop_event is not None and stop_event.is_set():
+        result['stopped'] = True
+        return result
+    # Per-image messages use %-style arguments so they are only formatted
+    # when the record is actually emitted
+    download_path = f"{output_dir}/{image_id}.part"
+    try:
+        logger.info("Processing image %d/%d: %s", i, total, image_id)
+
+        if img_data is None:
+            img_data = fetch_image_metadata(image_id, api_session, rate_limiter, logger=logger)
+
+        # Skip images already saved by a previous run
+        capture = derive_capture_times(img_data, logger=logger)
+        filename = get_image_filename(image_id, capture)
+        if filename in existing_files:
+            logger.info("⏭️  Already downloaded, skipping: %s/%s", output_dir, filename)
+            result['skipped'] = True
+            return result
+
+        # Force use original geometry coordinates, avoid computed drift issues
+        if 'geometry' in img_data and img_data['geometry']:
+            coords = img_data['geometry']['coordinates']
+        else:
+            logger.error("❌ No available original coordinate information")
+            return result
+
+        def make_exif(size):
+            """Add comprehensive GPS EXIF data, with the actual image dimensions"""
+            if size is not None:
+                img_data['width'], img_data['height'] = size
+                logger.info("Image dimensions: %dx%d", *size)
+            return add_gps_exif_data(
                 coords[1],  # latitude
                 coords[0],  # longitude
-                img_id['id'],
+                image_id,
                 sequence_id,
-                img_data  # Pass all image metadata
+                img_data,  # Pass all image metadata
+                capture=capture,
+                download_time=download_time,
+                logger=logger
             )
 
-            # Check if EXIF creation was successful
-            if exif_bytes is None:
-                exif_error_count += 1
-                exif_error_images.append({
-                    'image_id': img_id['id'],
-                    'error_type': 'EXIF creation failed',
-                    'coordinates': coords,
-                    'metadata_keys': list(img_data.keys())
-                })
-                logger.warning(f"⚠️  EXIF creation failed for image {img_id['id']}")
-
-            # Generate filename based on capture time (use local time for filename only)
-            if 'captured_at' in img_data and img_data['captured_at']:
-                # Determine timezone offset from GPS coordinates
-                tz_offset = 0
-                if 'computed_geometry' in img_data and img_data['computed_geometry']:
-                    # Try to infer from GPS coordinates
-                    coords = img_data['computed_geometry']['coordinates']
-                    if coords and len(coords) >= 2:
-                        longitude = coords[0]
-                        tz_offset = int(longitude / 15)  # Rough timezone calculation
-
-                # Mapillary timestamp is in local timezone, keep as local time for filename
-                timestamp_sec = img_data['captured_at'] / 1000.0
-                logger.debug(f"Filename naming - Original captured_at: {img_data['captured_at']}")
-                logger.debug(f"Filename naming - Timestamp in seconds: {timestamp_sec}")
-                logger.debug(f"Filename naming - Timezone offset: {tz_offset}")
-
-                if tz_offset != 0:
-                    tz = timezone(timedelta(hours=tz_offset))
-                    capture_time_local = datetime.fromtimestamp(timestamp_sec, tz=tz)
-                    logger.debug(f"Filename naming - Using GPS timezone: {tz}")
-                else:
-                    # If no timezone info, use local system timezone
-                    capture_time_local = datetime.fromtimestamp(timestamp_sec)
-                    logger.debug(f"Filename naming - Using system timezone")
-
-                logger.debug(f"Filename naming - Local timestamp: {capture_time_local}")
-                logger.debug(f"Filename naming - Microseconds: {capture_time_local.strftime('%f')}")
-                filename = f"{capture_time_local.strftime('%Y%m%d_%H%M%S')}_{capture_time_local.strftime('%f')[:3]}.jpg"
-                logger.debug(f"Filename naming - Generated filename: {filename}")
-            else:
-                filename = f"{img_id['id']}.jpg"
-
-            # Save image
-            output_path = f"{output_dir}/{filename}"
-            if exif_bytes:
-                if quality is not None:
-                    image.save(output_path, exif=exif_bytes, quality=quality)
-                    logger.info(f"✅ Image saved with GPS EXIF data (quality {quality}): {output_path}")
-                else:
-                    image.save(output_path, exif=exif_bytes)
-                    logger.info(f"✅ Image saved with GPS EXIF data (original quality): {output_path}")
-            else:
-                if quality is not None:
-                    image.save(output_path, quality=quality)
-                    logger.info(f"✅ Image saved (quality {quality}): {output_path}")
-                else:
-                    image.save(output_path)
-                    logger.info(f"✅ Image saved (original quality): {output_path}")
+        # Download and save image
+        image_get_url = img_data['thumb_original_url']
+        output_path = f"{output_dir}/{filename}"
+        logger.debug("Downloading image...")
+        if quality is None:
+            # Keep the original JPEG bytes and only splice in the EXIF segment
+            # while streaming, so the image is written once
+            exif_bytes = download_image_to(
+                image_get_url, download_path, image_session, rate_limiter,
+                write_body=lambda source, f: copy_jpeg_with_exif(source, f, make_exif),
+                logger=logger)
+            os.replace(download_path, output_path)
+        else:
+            download_image_to(image_get_url, download_path, image_session, rate_limiter, logger=logger)
+            # Get actual image dimensions from the downloaded image's SOF header;
+            # fall back to PIL (header only, no pixel decode) for non-JPEG data
+            size = read_jpeg_size(download_path)
+            if size is None:
+                with Image.open(download_path) as image:
+                    size = image.size
+            exif_bytes = make_exif(size)
+            # Re-encoding is needed; the JPEG decode/encode runs in the encoder process pool
+            encode_image(download_path, output_path, exif_bytes, quality, logger=logger)
+
+        # Check if EXIF creation was successful
+        if exif_bytes is None:
+            result['exif_error'] = {
+                'image_id': image_id,
+                'error_type': 'EXIF creation failed',
+                'coordinates': coords,
+                'metadata_keys': list(img_data.keys())
+            }
+            logger.warning("⚠️  EXIF creation failed for image %s", image_id)
+
+        logger.info("✅ Image saved%s (%s): %s",
+                    " with GPS EXIF data" if exif_bytes else "",
+                    "original quality" if quality is None else f"quality {quality}",
+                    output_path)
 
-            # Add delay to avoid rate limiting
-            time.sleep(0.5)
+    except Exception as e:
+        result['error'] = {
+            'image_id': image_id,
+            'error_type': type(e).__name__,
+            'error_message': str(e),
+            'image_index': i
+        }
+        logger.error("❌ Error processing image %s: %s", image_id, e)
 
-        except Exception as e:
-            error_count += 1
-            error_images.append({
-                'image_id': img_id['id'],
-                'error_type': type(e).__name__,
-                'error_message': str(e),
-                'image_index': i
-            })
-            logger.error(f"❌ Error processing image {img_id['id']}: {e}")
-            continue
+    finally:
+        # Remove the partial download if it was not moved into place
+        try:
+            os.remove(download_path)
+        except FileNotFoundError:
+            pass
+
+    return result
+
+def main(sequence_id, quality=None, specific_images=None, rate_limiter=None, workers=DEFAULT_WORKERS,
+         use_cache=True, overwrite=False, verbose=False, stop_event=None):
+    """
+    Main function to download all images in a sequence or specific images
+
+    Args:
+        sequence_id (str): Sequence ID to download
+        quality (int, optional): JPEG quality (1-100). If None, saves original quality
+        specific_images (list, optional): List of specific image IDs to download. If None, downloads all images
+        rate_limiter (RateLimiter, optional): Shared request rate limiter. If None, a private one is created
+        workers (int, optional): Number of images processed in parallel
+        use_cache (bool, optional): Reuse cached image lists and metadata younger than SEQUENCE_CACHE_TTL
+        overwrite (bool, optional): Download images again even if they already exist in the output directory
+        verbose (bool, optional): Also log debug messages
+        stop_event (threading.Event, optional): Once set, images that have not
+            started yet are left out (used by batch_downloader on Ctrl+C)
+
+    Returns:
+        bool: False if the download could not start (configuration error or
+        image list unavailable) or was stopped, True once all images were processed
+    """
+    # Setup logging
+    logger, log_filename = setup_logging(sequence_id, logging.DEBUG if verbose else logging.INFO)
 
-    # Output error statistics
-    logger.info("=" * 80)
-    logger.info("📊 Download Statistics")
-    logger.info(f"Total images: {len(image_ids)}")
-    logger.info(f"Successfully downloaded: {len(image_ids) - error_count}")
-    logger.info(f"Download failed: {error_count}")
-    logger.info(f"EXIF creation failed: {exif_error_count}")
+    api_session = image_session = None
+    try:
+        # Get access_token from config file
+        try:
+            from config import access_token
+        except ImportError:
+            logger.error("❌ config.py file not found!")
+            logger.error("Please create config.py file and set your access_token")
+            logger.error("You can copy config.example.py to config.py as a template")
+            return False
+
+        if not access_token:
+            logger.error("access_token is required in config.py")
+            return False
+
+        if not sequence_id:
+            logger.error("sequence_id is required")
+            return False
+
+        os.makedirs("downloads", exist_ok=True)
+
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(DEFAULT_RPS)
+
+        # Keep-alive sessions shared by all workers: one authenticated for the
+        # Graph API, one without credentials for the image CDN
+        api_session = create_session(access_token, pool_size=workers)
+        image_session = create_session(pool_size=workers)
+
+        # Get image IDs - either all images in sequence or specific images
+        if specific_images:
+            logger.info(f"Using specific images list: {len(specific_images)} images")
+            image_ids = [{'id': img_id} for img_id in specific_images]
+        else:
+            logger.info(f"Getting image list for sequence {sequence_id}...")
 
-    if error_images:
-        logger.info("\n❌ Failed downloads:")
-        for error in error_images:
-            logger.info(f"  - Image {error['image_index']}: {error['image_id']} ({error['error_type']}: {error['error_message']})")
+            try:
+                image_ids = load_cached_sequence_images(sequence_id, logger=logger) if use_cache else None
+                if image_ids is not None:
+                    logger.info(f"Found {len(image_ids)} images (cached)")
+                else:
+                    image_ids = fetch_sequence_images(sequence_id, api_session, rate_limiter, logger=logger)
+                    logger.info(f"Found {len(image_ids)} images")
+                    # An empty list may be a transient API glitch; don't keep it for a day
+                    if image_ids:
+                        save_cached_sequence_images(sequence_id, image_ids, logger=logger)
+            except Exception as e:
+                logger.error(f"Failed to get image list: {e}")
+                return False
 
-    if exif_error_images:
-        logger.info("\n⚠️  EXIF creation failed:")
-        for error in exif_error_images:
-            logger.info(f"  - {error['image_id']} (coordinates: {error['coordinates']})")
+        total = len(image_ids)
 
-    logger.info("🎉 Download completed!")
-    logger.info(f"📄 Detailed log saved to: {log_filename}")
+        # Look up metadata that did not come with the image list (specific
+        # images) in batches instead of one request per image
+        missing_ids = [img['id'] for img in image_ids if not has_image_metadata(img)]
+        if missing_ids:
+            metadata_by_id = {}
+            metadata_cache = None
+            try:
+                metadata_cache = MetadataCache()
+                if use_cache:
+                    metadata_by_id = metadata_cache.get_many(sequence_id, missing_ids)
+                    if metadata_by_id:
+                        logger.info(f"Found cached metadata for {len(metadata_by_id)} images")
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"⚠️  Metadata cache unavailable: {e}")
+
+            missing_ids = [image_id for image_id in missing_ids if image_id not in metadata_by_id]
+            if missing_ids:
+                logger.info(f"Fetching metadata for {len(missing_ids)} images...")
+                # Each batch is cached as soon as it arrives, so an interrupted
+                # run does not have to look it up again
+                on_batch = None
+                if metadata_cache is not None:
+                    def on_batch(batch):
+                        # A cache write error must not discard the fetched batch
+                        try:
+                            metadata_cache.put_many(sequence_id, batch)
+                        except (OSError, sqlite3.Error) as e:
+                            logger.warning(f"⚠️  Could not cache image metadata: {e}")
+                try:
+                    metadata_by_id.update(fetch_images_metadata(
+                        missing_ids, api_session, rate_limiter, on_batch=on_batch, logger=logger
+                    ))
+                except Exception as e:
+                    # Workers fall back to per-image requests
+                    logger.warning(f"⚠️  Batched metadata request failed, fetching per image: {e}")
+
+            if metadata_cache is not None:
+                metadata_cache.close()
+            image_ids = [metadata_by_id.get(img['id'], img) for img in image_ids]
+
+        # Initialize error statistics
+        error_images = []
+        exif_error_images = []
+
+        # Determine output directory name based on the first image whose
+        # metadata can be fetched, before the workers start
+        output_dir = None
+        first_index = 0
+        first_img_data = None
+        while first_index < total and output_dir is None:
+            image_id = image_ids[first_index]['id']
+            try:
+                first_img_data = image_ids[first_index]
+                if not has_image_metadata(first_img_data):
+                    first_img_data = fetch_image_metadata(image_id, api_session, rate_limiter, logger=logger)
+                output_dir = get_output_dir(sequence_id, first_img_data, logger=logger)
+                os.makedirs(output_dir, exist_ok=True)
+                logger.info(f"Output directory: {output_dir}")
+            except Exception as e:
+                error_images.append({
+                    'image_id': image_id,
+                    'error_type': type(e).__name__,
+                    'error_message': str(e),
+                    'image_index': first_index + 1
+                })
+                logger.error(f"❌ Error processing image {image_id}: {e}")
+                first_index += 1
+
+        # Read the output directory once so images saved by an earlier run are
+        # skipped without a per-image stat()
+        existing_files = frozenset()
+        if output_dir is not None and not overwrite:
+            # Empty files (e.g. from an older, non-atomic version) are downloaded again
+            with os.scandir(output_dir) as entries:
+                existing_files = frozenset(
+                    entry.name for entry in entries
+                    if entry.name.endswith('.jpg') and entry.stat().st_size > 0
+                )
+            if existing_files:
+                logger.info(f"Found {len(existing_files)} already downloaded images, they will be skipped")
+
+        # Every image of this run gets the same "Downloaded" time in its EXIF
+        download_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        # Process the remaining images in parallel; metadata that came with the
+        # image list (or was fetched above for the first image) is reused
+        skipped_count = 0
+        stopped_count = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    process_image, i, total, img_id['id'],
+                    first_img_data if i == first_index + 1 else (img_id if has_image_metadata(img_id) else None),
+                    output_dir, sequence_id, quality,
+                    api_session, image_session, rate_limiter, existing_files,
+                    download_time=download_time, stop_event=stop_event, logger=logger
+                )
+                for i, img_id in enumerate(image_ids[first_index:], first_index + 1)
+            ]
+            try:
+                for future in as_completed(futures):
+                    result = future.result()
+                    if result['error']:
+                        error_images.append(result['error'])
+                    if result['exif_error']:
+                        exif_error_images.append(result['exif_error'])
+                    if result['skipped']:
+                        skipped_count += 1
+                    if result['stopped']:
+                        stopped_count += 1
+            except BaseException:
+                # Ctrl+C: drop the queued images, only the ones in flight finish
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        error_images.sort(key=lambda error: error['image_index'])
+        error_count = len(error_images)
+        exif_error_count = len(exif_error_images)
+
+        # Output error statistics
+        logger.info("=" * 80)
+        logger.info("📊 Download Statistics")
+        logger.info(f"Total images: {len(image_ids)}")
+        logger.info(f"Successfully downloaded: {len(image_ids) - error_count - skipped_count - stopped_count}")
+        logger.info(f"Already downloaded (skipped): {skipped_count}")
+        if stopped_count:
+            logger.info(f"Not downloaded (stopped): {stopped_count}")
+        logger.info(f"Download failed: {error_count}")
+        logger.info(f"EXIF creation failed: {exif_error_count}")
+
+        if error_images:
+            logger.info("\n❌ Failed downloads:")
+            for error in error_images:
+                logger.info(f"  - Image {error['image_index']}: {error['image_id']} ({error['error_type']}: {error['error_message']})")
+
+        if exif_error_images:
+            logger.info("\n⚠️  EXIF creation failed:")
+            for error in exif_error_images:
+                logger.info(f"  - {error['image_id']} (coordinates: {error['coordinates']})")
+
+        if stopped_count:
+            logger.warning("⏹️  Download stopped before all images were processed")
+        else:
+            logger.info("🎉 Download completed!")
+        logger.info(f"📄 Detailed log saved to: {log_filename}")
+    finally:
+        if api_session is not None:
+            api_session.close()
+        if image_session is not None:
+            image_session.close()
+        close_logging(logger)
 
     # Output log file path to console
     print(f"\n📄 Detailed log saved to: {log_filename}")
+    return stopped_count == 0
 
 if __name__ == "__main__":
     import sys
@@ -576,6 +1177,16 @@ if __name__ == "__main__":
                        help='Specific image IDs to download (space-separated)')
     parser.add_argument('--image-file',
                        help='File containing image IDs (one per line)')
+    parser.add_argument('--rps', type=float, default=DEFAULT_RPS,
+                       help=f'Maximum API requests per second (default: {DEFAULT_RPS:g})')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                       help=f'Number of images processed in parallel (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--overwrite', action='store_true',
+                       help='Download images again even if they already exist in the output directory')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                       help='Log debug details (timezone and naming decisions, EXIF errors)')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Always fetch the sequence image list and image metadata instead of using the local cache')
 
     args = parser.parse_args()
 
@@ -584,6 +1195,14 @@ if __name__ == "__main__":
         print(f"❌ Quality parameter must be between 1-100, current value: {args.quality}")
         sys.exit(1)
 
+    if args.rps <= 0:
+        print(f"❌ Requests per second must be positive, current value: {args.rps}")
+        sys.exit(1)
+
+    if args.workers < 1:
+        print(f"❌ Workers must be at least 1, current value: {args.workers}")
+        sys.exit(1)
+
     # Handle specific images
     specific_images = None
     if args.images:
@@ -598,4 +1217,6 @@ if __name__ == "__main__":
             print(f"❌ File not found: {args.image_file}")
             sys.exit(1)
 
-    main(args.sequence_id, args.quality, specific_images)
+    if not main(args.sequence_id, args.quality, specific_images, RateLimiter(args.rps), args.workers,
+                use_cache=not args.no_cache, overwrite=args.overwrite, verbose=args.verbose):
+        sys.exit(1)